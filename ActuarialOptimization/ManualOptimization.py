@@ -9,11 +9,18 @@
 import numpy as np
 import pandas as pd
 import time
+import os
+import hashlib
+import pickle
 import scipy
 from scipy import optimize
 import warnings
 warnings.filterwarnings("error")
 
+#Version of the objective functions and stored result format, hashed into the result cache key.
+#Bump this whenever the objective, penalty, smooth surrogate or the stored result changes, so old results are not reused.
+CACHE_VERSION = 1
+
 class Data:
 
     """
@@ -36,6 +43,12 @@ class Data:
     :ivar actual: The name of the Actual Incurred Claims column in df
     :ivar expected: The name of the Manual Expected Claims column in df
     :ivar levels: The dictionary containing all factor levels for all variables passed from `variables`
+
+    **Note:** ``df`` is never modified by :class:`Optimize`, so the same instance can be reused for several runs
+    (different options, credibility settings or variable orderings) without reloading the data.
+    The ``actual`` and ``expected`` columns and the factor levels are copied when the instance is created, while credibility bounds
+    are read from ``df`` when :class:`Optimize` is created. So ``df`` must not be changed after the instance is created: if the data
+    needs fixing, fix ``df`` and create a new :class:`Data`.
     """
     def __init__(self, df, variables, actual, expected, inOrder=True, grouped = False):
         self.df = df
@@ -49,12 +62,40 @@ class Data:
         self.actual = actual
         self.expected = expected
         self.__getLevels()
+        self.__getArrays()
         self._initialAE = df[actual].sum()/df[expected].sum()
     def __getLevels(self):
         self.levels = {}
         #Putting factor levels into the dictionary
         for v in self.var_list:
             self.levels[v]=self.df[v].unique()
+    def __getArrays(self):
+        #Read-only copies of the columns used in the objective, so optimizing never has to touch df
+        self._actual_values = self.df[self.actual].to_numpy(dtype=float)
+        self._expected_values = self.df[self.expected].to_numpy(dtype=float)
+        #Position of each row's level within self.levels[v], used to map factors onto rows
+        self._codes = {}
+        for v in self.var_list:
+            self._codes[v] = pd.Index(self.levels[v]).get_indexer(self.df[v])
+        self._content_fingerprint = None
+    def fingerprint(self):
+        """
+        :return: A hash of the data content used in optimization (actual, expected, factor levels) and of the current
+            ``var_list``, ``inOrder`` and ``grouped`` settings.
+        :rtype: str
+        """
+        #The arrays are never modified, so their hash is only computed once. The settings can be changed between runs.
+        if self._content_fingerprint is None:
+            h = hashlib.sha1()
+            h.update(self._actual_values.tobytes())
+            h.update(self._expected_values.tobytes())
+            for v in self._codes:
+                h.update(repr((v, list(self.levels[v]))).encode())
+                h.update(self._codes[v].tobytes())
+            self._content_fingerprint = h.hexdigest()
+        h = hashlib.sha1(self._content_fingerprint.encode())
+        h.update(repr((list(self.var_list), self.inOrder, self.grouped)).encode())
+        return h.hexdigest()
 class Options:
     """
     Class containing specifications about optimization technique. Most of the arguments can be left as defaults.
@@ -94,6 +135,21 @@ class Options:
         **Note: Seems to not converge in finite time? I wouldn't utilize this argument**
     :param workers: If workers is an int the population is subdivided into workers sections and evaluated in parallel (uses **multiprocessing.Pool**). Supply -1 to use all available CPU cores. Alternatively supply a map-like callable, such as multiprocessing.Pool.map for evaluating the population in parallel. This evaluation is carried out as workers ``(func, iterable)``. This option will override the updating keyword to ``updating='deferred'`` if ``workers != 1``. Requires that func be pickleable.
         **Note: See above note**
+    :param max_time: Maximum wall-clock time in seconds for :meth:`Optimize.run`. When it runs out, the optimization stops and returns the best factors found so far.
+        In sequential mode the time is split across ``var_list`` in proportion to the number of levels of each variable (time left over by a variable is passed on to the next ones).
+        Default is ``None`` (no limit).
+    :param max_evals: Maximum number of objective evaluations for :meth:`Optimize.run`, split across ``var_list`` in the same way as ``max_time``. Default is ``None`` (no limit).
+        **Note: Both budgets are checked after every evaluation when** ``workers = 1``. **Otherwise they are checked once per generation, and the number of evaluations is estimated from the population size, so a run can overshoot by up to one generation.**
+    :param smooth_polish: If True (and ``polish`` is True), the polish stage runs L-BFGS-B on a smooth (Huber) version of the absolute deviation
+        with an exact gradient, instead of letting `SciPy` approximate the gradient of the non-smooth objective by finite differences
+        (one full pass over the data per factor, per step). The polished factors are kept only if they lower the actual absolute deviation.
+        Default is False.
+    :param huber_delta: Width of the quadratic region of the Huber deviation used by ``smooth_polish``, as a fraction of the average actual claims
+        per deviation term. Smaller values follow the absolute deviation more closely.
+    :param cache: If True (default), results are stored on disk, and :meth:`Optimize.run` returns a stored result immediately when the same data, options and credibility settings have been run before.
+        Only repeatable runs are stored, i.e. ``seed`` is an int and no ``callback`` or callable ``workers`` is given. Set to False to bypass the store entirely.
+    :param cache_dir: Directory of the result store. Default is ``~/.ActuarialOptimization/cache``.
+    :param cache_size: Maximum number of results kept in the store. When it is full, the least recently used result is removed.
     :type data: :class:`Data`
     :type strategy: str, optional
     :type maxiter: int, optional
@@ -109,12 +165,20 @@ class Options:
     :type atol: float, optional
     :type updating: {'immediate','deferred'}, optional
     :type workers: int or map-like callable, optional
+    :type max_time: float, optional
+    :type max_evals: int, optional
+    :type smooth_polish: bool, optional
+    :type huber_delta: float, optional
+    :type cache: bool, optional
+    :type cache_dir: str, optional
+    :type cache_size: int, optional
     """
 
 
     def __init__(self, data, strategy='best1bin', maxiter=1000, popsize=15, tol=0.01, mutation=(0.5, 1),
                  recombination=0.7, seed=None,  disp=False, callback=None, polish=True, init='latinhypercube', atol=0,
-                 updating='immediate', workers=1):
+                 updating='immediate', workers=1, max_time=None, max_evals=None, smooth_polish=False, huber_delta=0.01,
+                 cache=True, cache_dir=None, cache_size=50):
 
         """
         Most options can be left as defaults, but `data` must be passed a Data class.
@@ -137,6 +201,109 @@ class Options:
         self.atol = atol
         self.updating = updating
         self.workers = workers
+        self.max_time = max_time
+        self.max_evals = max_evals
+        self.smooth_polish = smooth_polish
+        self.huber_delta = huber_delta
+        self.cache = cache
+        self.cache_dir = cache_dir if cache_dir else os.path.join(os.path.expanduser("~"), ".ActuarialOptimization", "cache")
+        self.cache_size = cache_size
+
+    def fingerprint(self):
+        """
+        :return: A hash of all optimization settings, or ``None`` if the run is not repeatable: ``seed`` is not an int
+            (``None`` or a ``np.random.RandomState`` give a different draw on every run), or ``callback`` or ``workers``
+            is a callable, which cannot be identified reliably.
+        :rtype: str or None
+        """
+        if not isinstance(self.seed, (int, np.integer)) or isinstance(self.seed, bool):
+            return None
+        h = hashlib.sha1()
+        for name in sorted(vars(self)):
+            if name in ("data", "cache", "cache_dir", "cache_size"):
+                continue
+            value = getattr(self, name)
+            if callable(value):
+                return None
+            if isinstance(value, np.ndarray):
+                value = (value.shape, value.tobytes())
+            h.update(repr((name, value)).encode())
+        return h.hexdigest()
+
+
+class _BudgetExhausted(Exception):
+    """
+    Raised from the objective functions when ``max_time`` or ``max_evals`` runs out, to stop the optimizer.
+    """
+
+
+class _ResultCache:
+    """
+    On-disk store of finished optimizations, one pickle file per key. Keeps at most ``max_entries`` results,
+    evicting the least recently used (by file modification time, which is refreshed on every hit).
+    """
+
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def get(self, key):
+        """
+        :return: The stored value for ``key``, or ``None`` if there is none.
+        """
+        path = self.__path(key)
+        try:
+            with open(path, "rb") as file:
+                value = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            #Unreadable entry (e.g. interrupted write from an older version), treat as a miss
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.__path(key)
+        temp = path + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(temp, "wb") as file:
+                pickle.dump(value, file)
+            os.replace(temp, path)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+        self.__evict()
+
+    def __evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pkl"):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
 
 class Optimize:
@@ -154,6 +321,7 @@ class Optimize:
     :type lifeYears: str, optional
     :ivar bounds_lower: Dictionary containing lower bounds for the factor changes based off of credibility.
     :ivar bounds_upper: Dictionary containing upper bounds for the factor changes based off of credibility.
+    :ivar budget_exhausted: True if the last call to :meth:`run` was stopped by ``max_time`` or ``max_evals`` in :class:`Options`.
     :ivar res: The OptimizeResult containing information on the Differential Evolution result. See `this page <https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.OptimizeResult.html#scipy.optimize.OptimizeResult>`_ for more information.
 
             ** ``res`` Attributes**
@@ -166,6 +334,7 @@ class Optimize:
 
             * ``status``: ``int``
             Termination status of the optimizer. Its value depends on the underlying solver. Refer to message for details.
+            ``-1`` means ``max_time`` or ``max_evals`` ran out, and ``x`` holds the best factors found before that.
 
             * ``message``: ``str``
             Description of the cause of the termination.
@@ -186,6 +355,7 @@ class Optimize:
             The maximum constraint violation.
 
 
+    :type budget_exhausted: bool
     :type bounds_lower: dict
     :type bounder_upper: dict
     :type bounds: dict
@@ -215,6 +385,9 @@ class Optimize:
         self.__checkCredibility()
         self.niter = 0
         self.res = None
+        self.budget_exhausted = False
+        self._track_budget = False
+        self._factors = np.ones(len(self.options.data._expected_values))
 
     def setCredibility(self, newCred):
         """
@@ -280,116 +453,334 @@ class Optimize:
             self.bounds_lower[v] = lb
             self.bounds_upper[v] = ub
 
-    def __abs_dev(self, factorlist, variable):
+    def __row_factors(self, factorlist, variable):
         """
         :param factorlist: The current set of factors for the given variable.
-        :param variable: The variable currently being optimized.
-        :return abs_dev: The resulting sum of absolute deviations of Actual vs Expected across all policies for the given factorlist.
+        :param variable: The variable the factors belong to.
+        :return: Array containing the factor applied to each row of the data.
         """
-        global factor_dict
-        factor_dict = {}
-        for i in range(len(self.options.data.levels[variable])):
-            factor_dict[self.options.data.levels[variable][i]] = factorlist[i]
+        return np.asarray(factorlist, dtype=float)[self.options.data._codes[variable]]
 
-        new_exp_weighted = sum(
-            self.options.data.df[self.options.data.expected] * self.options.data.df[variable].map(factor_dict))
+    def __all_row_factors(self, factorlist):
+        """
+        :param factorlist: The current set of factors for all variables, in the order of ``var_list``.
+        :return: Array containing the product of all variable factors for each row of the data.
+        """
+        factors = np.ones(len(self.options.data._expected_values))
+        overall = 0
+        for v in self.options.data.var_list:
+            nlevels = len(self.options.data.levels[v])
+            factors = factors * self.__row_factors(factorlist[overall:overall + nlevels], v)
+            overall += nlevels
+        return factors
 
-        new_AE = sum(self.options.data.df[self.options.data.actual].values) / new_exp_weighted
-        abs_dev = sum(abs(self.options.data.df[self.options.data.expected] * self.options.data.df[variable].map(factor_dict) *
-                          new_AE - self.options.data.df[self.options.data.actual].values))
+    def __deviation(self, new_expected):
+        """
+        :param new_expected: Array of expected claims after applying factors.
+        :return: Tuple of the rebalanced AE and the sum of absolute deviations of Actual vs Expected across all policies.
+        """
+        actual = self.options.data._actual_values
+        new_AE = actual.sum() / new_expected.sum()
+        return new_AE, np.abs(new_expected * new_AE - actual).sum()
 
+    def __finish_evaluation(self, factorlist, abs_dev, new_AE):
+        """
+        Penalizes factor sets that move the overall AE more than 5%, keeps count of evaluations and the best factors so far,
+        and stops the optimizer if the budget has run out.
+        """
         if new_AE < self.options.data._initialAE * 0.95 or new_AE > self.options.data._initialAE * 1.05:
             abs_dev += 1e10
         self.niter += 1
         if self.niter % 100 == 0:
             print("Just finished deviation evaluation #:",self.niter)
+        if abs_dev < self._best_fun:
+            self._best_fun = abs_dev
+            self._best_x = np.array(factorlist, dtype=float)
+        if self._track_budget:
+            self._stage_evals += 1
+            self.__check_budget()
         return abs_dev
 
+    def __set_budget(self, share):
+        """
+        Gives the next optimization stage ``share`` of what is left of ``max_time`` and ``max_evals``.
+        """
+        now = time.time()
+        self._deadline = None if self._run_deadline is None else now + (self._run_deadline - now) * share
+        self._eval_limit = None if self._evals_left is None else int(self._evals_left * share)
+        self._stage_evals = 0
+        self._best_x = None
+        self._best_fun = np.inf
+
+    def __check_budget(self):
+        if self._eval_limit is not None and self._stage_evals >= self._eval_limit:
+            raise _BudgetExhausted("maximum number of evaluations (max_evals)")
+        if self._deadline is not None and time.time() >= self._deadline:
+            raise _BudgetExhausted("maximum wall-clock time (max_time)")
+
+    def __budget_callback(self, xk, convergence=None):
+        """
+        Differential evolution callback, used when a budget is set. Checks the budget once per generation, which is the
+        only place it can be checked when the population is evaluated by parallel workers.
+        """
+        self._generations += 1
+        halt = bool(self.options.callback(xk, convergence=convergence)) if self.options.callback else False
+        if not self._track_budget:
+            self._stage_evals = self._population * (self._generations + 1)
+        try:
+            self.__check_budget()
+        except _BudgetExhausted as reason:
+            self._halted_by = str(reason)
+            halt = True
+        return halt
+
+    def __mark_exhausted(self, reason):
+        if not self.budget_exhausted:
+            self._exhausted_reason = reason
+        self.budget_exhausted = True
+        self.res.success = False
+        self.res.status = -1
+        self.res.message = "Budget exhausted: reached the " + reason + ". Returning the best factors found so far."
+
+    def __keep_if_better_than_identity(self, objective, nfactors, args):
+        """
+        Used when a stage is cut off by the budget. Its best factors are only kept if they beat leaving every factor at 1,
+        otherwise the stage is left neutral. This check is not counted against the budget.
+        """
+        self._track_budget = False
+        identity = np.ones(nfactors)
+        identity_fun = objective(identity, *args)
+        if self.res.x is None or identity_fun <= self.res.fun:
+            self.res.x = identity
+            self.res.fun = identity_fun
+
+    def _abs_dev(self, factorlist, variable):
+        """
+        :param factorlist: The current set of factors for the given variable.
+        :param variable: The variable currently being optimized.
+        :return abs_dev: The resulting sum of absolute deviations of Actual vs Expected across all policies for the given factorlist.
+        """
+        new_expected = self.options.data._expected_values * self._factors * self.__row_factors(factorlist, variable)
+        new_AE, abs_dev = self.__deviation(new_expected)
+        return self.__finish_evaluation(factorlist, abs_dev, new_AE)
+
     def __change_manual_expected(self, factorlist, factor):
-        factor_dict = {}
-        for i in range(len(self.options.data.levels[factor])):
-            factor_dict[self.options.data.levels[factor][i]] = factorlist[i]
-        self.options.data.df[self.options.data.expected] = self.options.data.df[self.options.data.expected]\
-                                                         * self.options.data.df[factor].map(factor_dict)
+        """
+        Folds the optimized factors for ``factor`` into the cumulative factor array used by later variables.
+        The underlying data is left untouched.
+        """
+        self._factors = self._factors * self.__row_factors(factorlist, factor)
 
-    def __abs_dev_inOrder(self, factorlist):
+    def _abs_dev_inOrder(self, factorlist):
         """
         :param factorlist: The current set of factors for the given variables.
         :return abs_dev: The resulting sum of absolute deviations of Actual vs Expected across all policies for the given factorlist.
         """
-        variables = self.options.data.var_list
-        global factor_dict
-        factor_dict = {}
-        overall = 0
-        for v in variables:
-            factor_dict[v]={}
-            for i in range(len(self.options.data.levels[v])):
-                factor_dict[v][self.options.data.levels[v][i]] = factorlist[overall]
-                overall += 1
-        self.options.data.df["new_exp_weighted_factors"]=1
-        for var in variables:
-            self.options.data.df["new_exp_weighted_factors"]=self.options.data.df["new_exp_weighted_factors"]*\
-                                                             self.options.data.df[var].map(factor_dict[var])
-        new_exp_weighted = sum(self.options.data.df[self.options.data.expected]*self.options.data.df["new_exp_weighted_factors"])
-
-        new_AE = sum(self.options.data.df[self.options.data.actual].values) / new_exp_weighted
-        abs_dev = sum(
-            abs(self.options.data.df[self.options.data.expected]*self.options.data.df["new_exp_weighted_factors"] *
-                new_AE - self.options.data.df[self.options.data.actual].values))
-        if new_AE < self.options.data._initialAE * 0.95 or new_AE > self.options.data._initialAE * 1.05:
-            abs_dev += 1e10
-        self.niter += 1
-        if self.niter % 100 == 0:
-            print("Just finished deviation evaluation #:",self.niter)
-        return abs_dev
+        new_expected = self.options.data._expected_values * self.__all_row_factors(factorlist)
+        new_AE, abs_dev = self.__deviation(new_expected)
+        return self.__finish_evaluation(factorlist, abs_dev, new_AE)
 
+    def __grouped_sums(self, values):
+        """
+        :param values: Array with one value per row of the data.
+        :return: Array of ``values`` summed by factor level, for every variable in ``var_list``.
+        """
+        sums = []
+        for v in self.options.data.var_list:
+            sums.append(np.bincount(self.options.data._codes[v], weights=values,
+                                    minlength=len(self.options.data.levels[v])))
+        return np.concatenate(sums)
 
-    def __abs_dev_grouped(self, factorlist):
+    def _abs_dev_grouped(self, factorlist):
         """
         :param factorlist: The current set of factors for the given variables.
         :return abs_dev: The resulting sum of absolute deviations of Actual vs Expected across all policies for the given factorlist.
         """
+        new_expected = self.options.data._expected_values * self.__all_row_factors(factorlist)
+        expecteds = self.__grouped_sums(new_expected)
+        actuals = self.__grouped_sums(self.options.data._actual_values)
 
+        new_AE = self.options.data._actual_values.sum() / new_expected.sum()
 
-        variables = self.options.data.var_list
-        global factor_dict
-        factor_dict = {}
-        overall = 0
-        expecteds = []
-        actuals = []
-        for v in variables:
-            factor_dict[v]={}
-            for i in range(len(self.options.data.levels[v])):
-                factor_dict[v][self.options.data.levels[v][i]] = factorlist[overall]
-                overall += 1
-        self.options.data.df["new_exp_weighted_factors"]=1
-
-        for var in variables:
-            self.options.data.df["new_exp_weighted_factors"]=self.options.data.df["new_exp_weighted_factors"]*\
-                                                             self.options.data.df[var].map(factor_dict[var])
-
-        self.options.data.df["new_exp_weighted_AO"] = self.options.data.df[self.options.data.expected]*self.options.data.df["new_exp_weighted_factors"]
-        new_exp_weighted = self.options.data.df["new_exp_weighted_AO"].sum()
-        for var in variables:
-            expecteds = np.append(expecteds,(self.options.data.df["new_exp_weighted_AO"].groupby(self.options.data.df[var])).sum())
-            actuals = np.append(actuals,(self.options.data.df[self.options.data.actual].groupby(self.options.data.df[var])).sum())
+        abs_dev = np.abs(expecteds*new_AE - actuals).sum()
+        return self.__finish_evaluation(factorlist, abs_dev, new_AE)
 
-        new_AE = sum(self.options.data.df[self.options.data.actual].values) / new_exp_weighted
 
-        abs_dev = sum(abs(expecteds*new_AE - actuals))
-        if new_AE < self.options.data._initialAE * 0.95 or new_AE > self.options.data._initialAE * 1.05:
-            abs_dev += 1e10
-        self.niter += 1
-        if self.niter % 100 == 0:
-            print("Just finished deviation evaluation #:",self.niter)
-        return abs_dev
 
+    def __smooth_dev(self, factorlist, variables, base):
+        """
+        Huber-smoothed version of the absolute deviation objectives, used for polishing.
+        :param factorlist: The current set of factors for ``variables``, in order.
+        :param variables: The variables being optimized.
+        :param base: Array of factors already applied to each row (the cumulative factors in sequential mode).
+        :return: Tuple of the smoothed deviation and its gradient with respect to each factor in ``factorlist``.
+        """
+        if self._track_budget:
+            self._stage_evals += 1
+            self.__check_budget()
+        data = self.options.data
+        factorlist = np.asarray(factorlist, dtype=float)
+        new_expected = data._expected_values * base
+        overall = 0
+        for v in variables:
+            nlevels = len(data.levels[v])
+            new_expected = new_expected * factorlist[overall:overall + nlevels][data._codes[v]]
+            overall += nlevels
+
+        total_actual = data._actual_values.sum()
+        total_expected = new_expected.sum()
+        new_AE = total_actual / total_expected
+        #d(new_AE)/d(row expected), the same for every row
+        dAE = -total_actual / total_expected ** 2
+
+        if data.grouped:
+            expecteds = self.__grouped_sums(new_expected)
+            residuals = expecteds * new_AE - self.__grouped_sums(data._actual_values)
+        else:
+            residuals = new_expected * new_AE - data._actual_values
+        delta = self.options.huber_delta * total_actual / len(residuals)
+        quadratic = np.abs(residuals) <= delta
+        value = np.where(quadratic, residuals ** 2 / (2 * delta), np.abs(residuals) - delta / 2).sum()
+        slopes = np.clip(residuals / delta, -1, 1)
+
+        #Gradient of the smoothed deviation with respect to each row's new expected
+        if data.grouped:
+            row_grad = np.zeros(len(new_expected))
+            overall = 0
+            for v in data.var_list:
+                nlevels = len(data.levels[v])
+                row_grad += slopes[overall:overall + nlevels][data._codes[v]]
+                overall += nlevels
+            row_grad = row_grad * new_AE + dAE * np.dot(slopes, expecteds)
+        else:
+            row_grad = slopes * new_AE + dAE * np.dot(slopes, new_expected)
+
+        #Smooth version of the 1e10 penalty on moving the overall AE more than 5%
+        lower = self.options.data._initialAE * 0.95
+        upper = self.options.data._initialAE * 1.05
+        excess = max(new_AE - upper, 0) - max(lower - new_AE, 0)
+        value += 1e10 * (excess / self.options.data._initialAE) ** 2
+        row_grad = row_grad + 2e10 * excess / self.options.data._initialAE ** 2 * dAE
+
+        #Each factor scales the rows at its level, so its gradient is a per-level sum
+        row_grad = row_grad * new_expected
+        gradient = []
+        overall = 0
+        for v in variables:
+            nlevels = len(data.levels[v])
+            gradient.append(np.bincount(data._codes[v], weights=row_grad, minlength=nlevels)
+                            / factorlist[overall:overall + nlevels])
+            overall += nlevels
+        return value, np.concatenate(gradient)
 
+    def __evolve(self, objective, bounds, variables, args=()):
+        """
+        Runs the differential evolution on ``objective`` and saves the result under ``res``. If ``smooth_polish`` is set,
+        the polish stage is done here on the smoothed deviation instead of inside `SciPy`. The polish is also done here when
+        a budget is set, since `SciPy` still polishes after the budget callback halts the evolution.
+        :param objective: The absolute deviation function being minimized.
+        :param bounds: List of (lower, upper) bounds for each factor.
+        :param variables: The variables whose factors are being optimized.
+        :param args: Extra arguments passed to ``objective``.
+        """
+        smooth = self.options.polish and self.options.smooth_polish
+        budgeted = self.options.max_time is not None or self.options.max_evals is not None
+        own_polish = self.options.polish and (smooth or budgeted)
+        self._track_budget = budgeted and self.options.workers == 1
+        self._generations = 0
+        self._halted_by = None
+        if isinstance(self.options.init, str):
+            self._population = self.options.popsize * len(bounds)
+        else:
+            self._population = len(self.options.init)
+        if budgeted:
+            try:
+                self.__check_budget()
+            except _BudgetExhausted as reason:
+                #Nothing left for this stage, so its factors stay at 1
+                self.res = scipy.optimize.OptimizeResult(x = None, fun = np.inf, nfev = 0, nit = 0)
+                self.__keep_if_better_than_identity(objective, len(bounds), args)
+                self.__mark_exhausted(str(reason))
+                return
+        try:
+            self.res = scipy.optimize.differential_evolution(objective, bounds = bounds, args = args,
+                                                             strategy = self.options.strategy,
+                                                             maxiter = self.options.maxiter,
+                                                             popsize = self.options.popsize, tol = self.options.tol,
+                                                             mutation = self.options.mutation,
+                                                             recombination = self.options.recombination,
+                                                             seed = self.options.seed,
+                                                             callback = self.__budget_callback if budgeted else self.options.callback,
+                                                             disp = self.options.disp,
+                                                             polish = self.options.polish and not own_polish,
+                                                             init = self.options.init, atol = self.options.atol,
+                                                             updating = self.options.updating,
+                                                             workers = self.options.workers)
+        except _BudgetExhausted as reason:
+            self.res = scipy.optimize.OptimizeResult(x = self._best_x, fun = self._best_fun, nfev = self._stage_evals,
+                                                     nit = self._generations)
+            self.__keep_if_better_than_identity(objective, len(bounds), args)
+            self.__mark_exhausted(str(reason))
+            return
+        if self._halted_by:
+            self.__keep_if_better_than_identity(objective, len(bounds), args)
+            self.__mark_exhausted(self._halted_by)
+            return
+        if not own_polish:
+            return
+        #The polish always runs in this process, so the budget can be checked on every evaluation
+        self._track_budget = budgeted
+        self._stage_evals = self.res.nfev
+        try:
+            if smooth:
+                base = self._factors if self.options.data.inOrder else np.ones(len(self._factors))
+                polished = scipy.optimize.minimize(self.__smooth_dev, self.res.x, args = (variables, base), jac = True,
+                                                   method = "L-BFGS-B", bounds = bounds)
+            else:
+                polished = scipy.optimize.minimize(objective, self.res.x, args = args, method = "L-BFGS-B", bounds = bounds)
+        except _BudgetExhausted as reason:
+            if self._best_fun < self.res.fun:
+                self.res.x = self._best_x
+                self.res.fun = self._best_fun
+            self.__keep_if_better_than_identity(objective, len(bounds), args)
+            self.__mark_exhausted(str(reason))
+            return
+        polished_x = np.clip(polished.x, [low for low, high in bounds], [high for low, high in bounds])
+        #The polish finished within budget, so always allow the one evaluation needed to check it
+        self._track_budget = False
+        polished_fun = objective(polished_x, *args)
+        self.res.nfev += polished.nfev + 1
+        if polished_fun < self.res.fun:
+            self.res.x = polished_x
+            self.res.fun = polished_fun
+
+    def fingerprint(self):
+        """
+        :return: A hash identifying this optimization: the data content, all options, the credibility settings, and
+            ``CACHE_VERSION`` and the `SciPy` version, so results from older code are not reused.
+            ``None`` if the options cannot be fingerprinted.
+        :rtype: str or None
+        """
+        options_fingerprint = self.options.fingerprint()
+        if options_fingerprint is None:
+            return None
+        h = hashlib.sha1()
+        h.update(repr((CACHE_VERSION, scipy.__version__)).encode())
+        h.update(self.options.data.fingerprint().encode())
+        h.update(options_fingerprint.encode())
+        h.update(repr((self.credibility, self.lifeYears)).encode())
+        for var in self.options.data.var_list:
+            h.update(np.asarray(self.bounds_lower[var], dtype=float).tobytes())
+            h.update(np.asarray(self.bounds_upper[var], dtype=float).tobytes())
+        return h.hexdigest()
 
     def run(self):
         """
         Runs the `differential_evolution <https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.differential_evolution.html#scipy.optimize.differential_evolution>`_
         minimizing the absolute deviation of Manual Expected to Incurred by setting sets of factors to be multiplied by the original Manual Expected.
+        If ``cache`` is set in :class:`Options` and the same optimization has been run before, the stored result is returned (and set as ``res``) without rerunning.
+        If ``max_time`` or ``max_evals`` is set in :class:`Options` and runs out, the optimization stops early, ``budget_exhausted`` is set to True,
+        and the best factors found so far are returned.
         :return: Tuple of the a dictionary containing variables and their factors, along with minimized absolute deviation and AE.
         **Note: When using** ``Optimize.run()``, **it should be assigned as follows.**
         ``final_dictionary, endingAE, endingAbsDev = myOptimize.run()``
@@ -399,13 +790,39 @@ class Optimize:
         print("|             Running Actuarial Optimization             |")
         print("̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅̅")
         print("==========================================================")
+        cache = None
+        key = None
+        if self.options.cache:
+            key = self.fingerprint()
+            if key is not None:
+                cache = _ResultCache(self.options.cache_dir, self.options.cache_size)
+                stored = cache.get(key)
+                if stored is not None:
+                    final_dict, endingAE, endingdev, self.res = stored
+                    self.budget_exhausted = False
+                    print("Found stored result for this data and options, skipping optimization.")
+                    print("Ending AE", endingAE)
+                    print("Ending absolute deviation: ", endingdev)
+                    return final_dict, endingAE, endingdev
+
+        final_dict, endingAE, endingdev = self.__optimize()
+        #Results cut short by max_time depend on machine speed, so they are not stored
+        if cache is not None and not self.budget_exhausted:
+            try:
+                cache.put(key, (final_dict, endingAE, endingdev, self.res))
+            except (OSError, pickle.PicklingError) as error:
+                print("WARNING: Could not store result in "+str(self.options.cache_dir)+" ("+str(error)+"). Returning it without storing.")
+        return final_dict, endingAE, endingdev
+
+    def __optimize(self):
         final_dict = {}
-        start_dev = sum(abs(self.options.data.df[self.options.data.expected].values *
-                            sum(self.options.data.df[self.options.data.actual].values) /
-                            sum(self.options.data.df[self.options.data.expected].values)
-                            - self.options.data.df[self.options.data.actual].values))
+        self._factors = np.ones(len(self.options.data._expected_values))
+        self.budget_exhausted = False
+        self._run_deadline = None if self.options.max_time is None else time.time() + self.options.max_time
+        self._evals_left = self.options.max_evals
+        start_AE, start_dev = self.__deviation(self.options.data._expected_values)
 
-        print("Starting AE", sum(self.options.data.df[self.options.data.actual])/sum(self.options.data.df[self.options.data.expected]))
+        print("Starting AE", start_AE)
 
         if self.options.data.inOrder: #Meaning to optimize sequentially
             print("Starting absolute deviation: ", start_dev)
@@ -413,37 +830,40 @@ class Optimize:
             print("__________________________________________________________")
 
             current = 1
+            levels_left = sum(len(self.options.data.levels[v]) for v in self.options.data.var_list)
             for f in self.options.data.var_list:
                 print("Currently working on "+f+", variable "+str(current)+"/"+str(len(self.options.data.var_list))+".")
-                print("Absolute Deviation before working on "+f+": "+ str(sum(abs(self.options.data.df[self.options.data.expected].values *
-                                sum(self.options.data.df[self.options.data.actual].values) /
-                                sum(self.options.data.df[self.options.data.expected].values)
-                                - self.options.data.df[self.options.data.actual].values))))
+                print("Absolute Deviation before working on "+f+": "+
+                      str(self.__deviation(self.options.data._expected_values * self._factors)[1]))
                 current += 1
                 xmin = self.bounds_lower[f]
                 xmax = self.bounds_upper[f]
                 bounds = [(low, high) for low, high in zip(xmin, xmax)]
 
-                self.res = scipy.optimize.differential_evolution(self.__abs_dev, bounds = bounds, args = (f,),
-                                                            strategy = self.options.strategy, maxiter = self.options.maxiter,
-                                                            popsize = self.options.popsize, tol = self.options.tol,
-                                                            mutation = self.options.mutation, recombination = self.options.recombination,
-                                                            seed = self.options.seed, callback = self.options.callback,
-                                                            disp = self.options.disp, polish = self.options.polish,
-                                                            init = self.options.init, atol = self.options.atol,
-                                                            updating = self.options.updating, workers= self.options.workers)
+                self.__set_budget(len(self.options.data.levels[f]) / levels_left)
+                levels_left -= len(self.options.data.levels[f])
+                self.__evolve(self._abs_dev, bounds, [f], args = (f,))
+                if self._evals_left is not None:
+                    self._evals_left = max(0, self._evals_left - self.res.nfev)
                 temp_dict = {}
 
                 for k in range(len(self.options.data.levels[f])):
-                    temp_dict[self.options.data.levels[f][k]] = res.x[k]
+                    temp_dict[self.options.data.levels[f][k]] = self.res.x[k]
                 final_dict[f]=temp_dict.copy()
                 self.__change_manual_expected(self.res.x, f)
+                if self.res.get("status") == -1:
+                    print(self.res.message)
                 print("Absolute Deviation after working on "+f+": "+ str(self.res.fun))
                 print("==========================================================")
 
-            endingAE = sum(self.options.data.df[self.options.data.actual])/sum(self.options.data.df[self.options.data.expected])
+            endingAE = self.__deviation(self.options.data._expected_values * self._factors)[0]
             endingdev = self.res.fun
-            print(self.res.message)
+            #res only holds the last variable, so also flag it if an earlier variable ran out of budget.
+            #If the last variable itself ran out, its message was already printed above.
+            if self.res.get("status") != -1:
+                if self.budget_exhausted:
+                    self.__mark_exhausted(self._exhausted_reason)
+                print(self.res.message)
             print("Ending optimization date and time",time.asctime( time.localtime(time.time()) ))
 
             return final_dict, endingAE, endingdev
@@ -452,13 +872,8 @@ class Optimize:
             if self.options.data.grouped:
 
 
-                actuals = []
-                expecteds = []
-                for var in self.options.data.var_list:
-                    expecteds = np.append(expecteds, (
-                        self.options.data.df[self.options.data.expected].groupby(self.options.data.df[var])).sum())
-                    actuals = np.append(actuals, (
-                        self.options.data.df[self.options.data.actual].groupby(self.options.data.df[var])).sum())
+                expecteds = self.__grouped_sums(self.options.data._expected_values)
+                actuals = self.__grouped_sums(self.options.data._actual_values)
 
 
                 abs_dev = abs(expecteds * self.options.data._initialAE - actuals).sum()
@@ -474,17 +889,8 @@ class Optimize:
                     xmax.extend(self.bounds_upper[var])
                 bounds = [(low, high) for low, high in zip(xmin, xmax)]
                 print("Calculating... please wait")
-                self.res = scipy.optimize.differential_evolution(self.__abs_dev_grouped, bounds = bounds,
-                                                            strategy = self.options.strategy,
-                                                            maxiter = self.options.maxiter,
-                                                            popsize = self.options.popsize, tol = self.options.tol,
-                                                            mutation = self.options.mutation,
-                                                            recombination = self.options.recombination,
-                                                            seed = self.options.seed, callback = self.options.callback,
-                                                            disp = self.options.disp, polish = self.options.polish,
-                                                            init = self.options.init, atol = self.options.atol,
-                                                            updating = self.options.updating,
-                                                            workers = self.options.workers)
+                self.__set_budget(1)
+                self.__evolve(self._abs_dev_grouped, bounds, self.options.data.var_list)
 
                 final_dict = {}
                 counter = 0
@@ -493,8 +899,7 @@ class Optimize:
                     for level in self.options.data.levels[key]:
                         final_dict[key][level] = self.res.x[counter]
                         counter += 1
-                endingAE = sum(self.options.data.df[self.options.data.actual]) / sum(
-                    self.options.data.df[self.options.data.expected] * self.options.data.df["new_exp_weighted_factors"])
+                endingAE = self.__deviation(self.options.data._expected_values * self.__all_row_factors(self.res.x))[0]
                 endingdev = self.res.fun
                 print(self.res.message)
                 print("Ending optimization date and time", time.asctime(time.localtime(time.time())))
@@ -512,17 +917,8 @@ class Optimize:
                     xmax.extend(self.bounds_upper[var])
                 bounds = [(low, high) for low, high in zip(xmin, xmax)]
                 print("Calculating... please wait")
-                self.res = scipy.optimize.differential_evolution(self.__abs_dev_inOrder, bounds = bounds,
-                                                            strategy = self.options.strategy,
-                                                            maxiter = self.options.maxiter,
-                                                            popsize = self.options.popsize, tol = self.options.tol,
-                                                            mutation = self.options.mutation,
-                                                            recombination = self.options.recombination,
-                                                            seed = self.options.seed, callback = self.options.callback,
-                                                            disp = self.options.disp, polish = self.options.polish,
-                                                            init = self.options.init, atol = self.options.atol,
-                                                            updating = self.options.updating,
-                                                            workers = self.options.workers)
+                self.__set_budget(1)
+                self.__evolve(self._abs_dev_inOrder, bounds, self.options.data.var_list)
 
                 final_dict = {}
                 counter = 0
@@ -531,7 +927,7 @@ class Optimize:
                     for level in self.options.data.levels[key]:
                         final_dict[key][level]=self.res.x[counter]
                         counter += 1
-                endingAE = sum(self.options.data.df[self.options.data.actual])/sum(self.options.data.df[self.options.data.expected]*self.options.data.df["new_exp_weighted_factors"])
+                endingAE = self.__deviation(self.options.data._expected_values * self.__all_row_factors(self.res.x))[0]
                 endingdev = self.res.fun
                 print(self.res.message)
                 print("Ending optimization date and time",time.asctime( time.localtime(time.time()) ))
@@ -0,0 +1,11 @@
+import numpy as np
+import pandas as pd
+
+
+def make_data(n=2000):
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({"A": rng.choice(list("abcd"), n), "B": rng.choice(list("xyz"), n),
+                       "C": rng.choice([1, 2, 3, 4, 5], n)})
+    df["exp"] = rng.gamma(2, 100, n)
+    df["act"] = df["exp"] * rng.gamma(5, 0.2, n) * df["A"].map({"a": .9, "b": 1.1, "c": 1, "d": 1.05})
+    return df
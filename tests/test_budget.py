@@ -0,0 +1,105 @@
+import contextlib
+import io
+import time
+import unittest
+
+import numpy as np
+
+from ActuarialOptimization import ManualOptimization as mo
+from tests.helpers import make_data
+
+
+class RecordingOptimize(mo.Optimize):
+    """
+    Records the evaluation limit given to each stage and the evaluations it used.
+    """
+
+    def _Optimize__evolve(self, objective, bounds, variables, args=()):
+        self.limits.append(self._eval_limit)
+        mo.Optimize._Optimize__evolve(self, objective, bounds, variables, args)
+        self.used.append(self.res.nfev)
+
+    def run(self):
+        self.limits = []
+        self.used = []
+        return mo.Optimize.run(self)
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_budget_no_worse_than_start(self):
+        df = make_data()
+        for inOrder in [True, False]:
+            data = mo.Data(df, ["A", "B", "C"], "act", "exp", inOrder=inOrder)
+            start_dev = np.abs(data._expected_values * data._initialAE - data._actual_values).sum()
+            for max_evals in [0, 10, 100]:
+                optimize = mo.Optimize(mo.Options(data, seed=1, cache=False, max_evals=max_evals))
+                _, _, endingdev = optimize.run()
+                self.assertTrue(optimize.budget_exhausted)
+                self.assertEqual(optimize.res.status, -1)
+                self.assertFalse(optimize.res.success)
+                self.assertLessEqual(endingdev, start_dev)
+                if not inOrder:
+                    self.assertLessEqual(optimize.res.nfev, max_evals)
+
+    def test_within_budget(self):
+        data = mo.Data(make_data(), ["A", "B"], "act", "exp", inOrder=False)
+        optimize = mo.Optimize(mo.Options(data, seed=1, maxiter=5, cache=False, max_evals=100000))
+        optimize.run()
+        self.assertFalse(optimize.budget_exhausted)
+
+    def test_sequential_split_by_levels(self):
+        #A, B and C have 4, 3 and 5 levels, and every stage runs out of its share
+        data = mo.Data(make_data(), ["A", "B", "C"], "act", "exp")
+        optimize = RecordingOptimize(mo.Options(data, seed=1, cache=False, max_evals=120))
+        optimize.run()
+        self.assertEqual(optimize.limits, [40, 30, 50])
+        self.assertEqual(optimize.used, optimize.limits)
+        self.assertLessEqual(sum(optimize.used), 120)
+        self.assertEqual(optimize.res.status, -1)
+
+    def test_sequential_carry_over(self):
+        data = mo.Data(make_data(), ["A", "B", "C"], "act", "exp")
+        optimize = RecordingOptimize(mo.Options(data, seed=1, maxiter=3, cache=False, max_evals=3000))
+        optimize.run()
+        #The first variable finishes early, and what it leaves is shared between the remaining levels
+        self.assertLess(optimize.used[0], optimize.limits[0])
+        self.assertEqual(optimize.limits[1], int((3000 - optimize.used[0]) * 3 / 8))
+        self.assertGreater(optimize.limits[1], 3000 * 3 // 12)
+        self.assertLessEqual(sum(optimize.used), 3000)
+
+    def test_max_time(self):
+        df = make_data(20000)
+        for inOrder in [True, False]:
+            data = mo.Data(df, ["A", "B", "C"], "act", "exp", inOrder=inOrder, grouped=not inOrder)
+            optimize = mo.Optimize(mo.Options(data, seed=1, maxiter=100000, tol=0, cache=False, max_time=0.5))
+            start = time.time()
+            optimize.run()
+            elapsed = time.time() - start
+            self.assertTrue(optimize.budget_exhausted)
+            self.assertEqual(optimize.res.status, -1)
+            self.assertGreaterEqual(elapsed, 0.5)
+            self.assertLess(elapsed, 1.5)
+
+    def test_parallel_workers(self):
+        df = make_data()
+        for inOrder in [True, False]:
+            data = mo.Data(df, ["A", "B", "C"], "act", "exp", inOrder=inOrder)
+            options = mo.Options(data, seed=1, cache=False, max_evals=500, workers=2, updating="deferred")
+            optimize = mo.Optimize(options)
+            optimize.run()
+            self.assertTrue(optimize.budget_exhausted)
+            if not inOrder:
+                #Checked once per generation, so it can overshoot by at most one population
+                self.assertLess(optimize.res.nfev, 500 + options.popsize * 12)
+
+    def test_exhausted_message_printed_once_per_variable(self):
+        data = mo.Data(make_data(), ["A", "B", "C"], "act", "exp")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            mo.Optimize(mo.Options(data, seed=1, cache=False, max_evals=0)).run()
+        self.assertEqual(output.getvalue().count("Budget exhausted"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from ActuarialOptimization import ManualOptimization as mo
+from tests.helpers import make_data
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.data = mo.Data(make_data(), ["A", "B"], "act", "exp")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def run_optimize(self, **kwargs):
+        kwargs.setdefault("seed", 1)
+        kwargs.setdefault("cache_dir", self.tempdir.name)
+        optimize = mo.Optimize(mo.Options(self.data, maxiter=5, **kwargs))
+        #niter counts objective evaluations, so it stays 0 on a cache hit
+        return optimize, optimize.run()
+
+    def test_hit_and_miss(self):
+        first, result = self.run_optimize()
+        self.assertGreater(first.niter, 0)
+        second, cached = self.run_optimize()
+        self.assertEqual(second.niter, 0)
+        self.assertEqual(cached[1:], result[1:])
+        self.assertEqual(cached[0], result[0])
+        third, _ = self.run_optimize(popsize=10)
+        self.assertGreater(third.niter, 0)
+
+    def test_miss_after_changing_data_settings(self):
+        self.run_optimize()
+        self.data.inOrder = False
+        optimize, _ = self.run_optimize()
+        self.assertGreater(optimize.niter, 0)
+
+    def test_unrepeatable_runs_not_cached(self):
+        for kwargs in [dict(seed=None), dict(callback=lambda xk, convergence=None: False)]:
+            self.run_optimize(**kwargs)
+            optimize, _ = self.run_optimize(**kwargs)
+            self.assertGreater(optimize.niter, 0)
+        self.assertEqual(os.listdir(self.tempdir.name), [])
+
+    def test_unwritable_cache_dir(self):
+        path = os.path.join(self.tempdir.name, "file")
+        open(path, "w").close()
+        optimize, result = self.run_optimize(cache_dir=os.path.join(path, "cache"))
+        self.assertEqual(len(result), 3)
+
+    def test_miss_after_version_change(self):
+        self.run_optimize()
+        version = mo.CACHE_VERSION
+        try:
+            mo.CACHE_VERSION = version + 1
+            optimize, _ = self.run_optimize()
+        finally:
+            mo.CACHE_VERSION = version
+        self.assertGreater(optimize.niter, 0)
+
+    def test_eviction(self):
+        for popsize in [5, 6, 7]:
+            self.run_optimize(popsize=popsize, cache_size=2)
+        self.assertEqual(len(os.listdir(self.tempdir.name)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from ActuarialOptimization import ManualOptimization as mo
+from tests.helpers import make_data
+
+
+class TestSourceData(unittest.TestCase):
+
+    def test_df_unmodified(self):
+        df = make_data()
+        original = df.copy()
+        for inOrder, grouped in [(True, False), (False, False), (False, True)]:
+            data = mo.Data(df, ["A", "B", "C"], "act", "exp", inOrder=inOrder, grouped=grouped)
+            mo.Optimize(mo.Options(data, seed=1, maxiter=5, cache=False)).run()
+            self.assertTrue(df.equals(original))
+            self.assertEqual(list(df.columns), list(original.columns))
+
+    def test_data_reused_across_runs(self):
+        data = mo.Data(make_data(), ["A", "B", "C"], "act", "exp")
+        first = mo.Optimize(mo.Options(data, seed=1, maxiter=5, cache=False)).run()
+        second = mo.Optimize(mo.Options(data, seed=1, maxiter=5, cache=False)).run()
+        self.assertEqual(first[1:], second[1:])
+        data.var_list = ["C", "B", "A"]
+        reordered = mo.Optimize(mo.Options(data, seed=1, maxiter=5, cache=False)).run()
+        self.assertEqual(list(reordered[0]), ["C", "B", "A"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+import numpy as np
+
+from ActuarialOptimization import ManualOptimization as mo
+from tests.helpers import make_data
+
+
+def real_deviation(data, final_dict):
+    factors = np.ones(len(data._expected_values))
+    for v in data.var_list:
+        factors = factors * data.df[v].map(final_dict[v]).to_numpy(dtype=float)
+    new_expected = data._expected_values * factors
+    new_AE = data._actual_values.sum() / new_expected.sum()
+    return np.abs(new_expected * new_AE - data._actual_values).sum()
+
+
+class TestSmoothGradient(unittest.TestCase):
+
+    def check_gradient(self, inOrder, grouped):
+        rng = np.random.RandomState(1)
+        data = mo.Data(make_data(), ["A", "B"], "act", "exp", inOrder=inOrder, grouped=grouped)
+        optimize = mo.Optimize(mo.Options(data, cache=False, huber_delta=0.5))
+        if inOrder:
+            #Sequential mode optimizes one variable on top of the factors already applied
+            variables = ["B"]
+            base = rng.uniform(0.9, 1.1, len(data._expected_values))
+        else:
+            variables = ["A", "B"]
+            base = np.ones(len(data._expected_values))
+        nfactors = sum(len(data.levels[v]) for v in variables)
+        #0.02 keeps the AE within 5% of the start, 0.2 moves it outside so the penalty gradient is checked too
+        for scale in [0.02, 0.2]:
+            x = 1 + rng.uniform(-scale, scale, nfactors)
+            _, gradient = optimize._Optimize__smooth_dev(x, variables, base)
+            numeric = np.zeros(nfactors)
+            for i, step in enumerate(np.eye(nfactors) * 1e-6):
+                numeric[i] = (optimize._Optimize__smooth_dev(x + step, variables, base)[0]
+                              - optimize._Optimize__smooth_dev(x - step, variables, base)[0]) / 2e-6
+            self.assertLess(np.max(np.abs(gradient - numeric)) / np.max(np.abs(numeric)), 1e-6)
+
+    def test_gradient_sequential(self):
+        self.check_gradient(inOrder=True, grouped=False)
+
+    def test_gradient_all_at_once(self):
+        self.check_gradient(inOrder=False, grouped=False)
+
+    def test_gradient_grouped(self):
+        self.check_gradient(inOrder=False, grouped=True)
+
+
+class MisleadingSurrogate(mo.Optimize):
+    """
+    Replaces the smooth deviation with one that drives every factor to its upper bound.
+    """
+
+    def _Optimize__smooth_dev(self, factorlist, variables, base):
+        return -np.sum(factorlist), -np.ones(len(factorlist))
+
+
+class TestSmoothPolish(unittest.TestCase):
+
+    def test_polish_no_worse_than_evolution(self):
+        df = make_data()
+        for grouped in [False, True]:
+            data = mo.Data(df, ["A", "B", "C"], "act", "exp", inOrder=False, grouped=grouped)
+            _, _, unpolished = mo.Optimize(mo.Options(data, seed=1, maxiter=10, polish=False, cache=False)).run()
+            options = mo.Options(data, seed=1, maxiter=10, smooth_polish=True, cache=False)
+            final_dict, _, polished = mo.Optimize(options).run()
+            self.assertLessEqual(polished, unpolished)
+            if not grouped:
+                self.assertAlmostEqual(polished, real_deviation(data, final_dict), delta=1e-6 * polished)
+
+    def test_worse_polish_rejected(self):
+        data = mo.Data(make_data(), ["A", "B", "C"], "act", "exp", inOrder=False)
+        unpolished = mo.Optimize(mo.Options(data, seed=1, maxiter=10, polish=False, cache=False))
+        expected = unpolished.run()
+        optimize = MisleadingSurrogate(mo.Options(data, seed=1, maxiter=10, smooth_polish=True, cache=False))
+        final_dict, endingAE, endingdev = optimize.run()
+        self.assertEqual(endingdev, expected[2])
+        self.assertEqual(final_dict, expected[0])
+        np.testing.assert_array_equal(optimize.res.x, unpolished.res.x)
+
+
+if __name__ == "__main__":
+    unittest.main()